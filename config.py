@@ -46,6 +46,21 @@ MAX_TIME_PER_RUN_SECONDS = None
 # None または 0 に設定すると、この機能は無効になります。
 ABSOLUTE_GAP_LIMIT = 0.99
 
+# Trueに設定すると、Or-Tools (CP-SAT) の探索ログ (進捗・下限値など) を表示します。
+# 多数のパターンを連続実行する場合は False にすると出力が大幅に減ります。
+LOG_SEARCH_PROGRESS = True
+
+# Or-Tools (CP-SAT) の線形化レベル (linearization_level) を指定します。
+# 0: 線形緩和なし, 1: 既定, 2: 掛け算制約なども含めて最大限に線形化 (LPが強くなるが1ノードあたりが重い)
+# None に設定すると、Or-Tools の既定値を使用します。
+# (複数ワーカー時は、既定でも LP を強化したワーカーが並列に動作します)
+SOLVER_LINEARIZATION_LEVEL = None
+
+# Or-Tools (CP-SAT) の対称性検出レベル (symmetry_level) を指定します。
+# 0: 無効, 1: presolve で検出, 2: 探索中にも対称性を利用 (同一構造のターゲットが多い場合に有効)
+# None に設定すると、Or-Tools の既定値を使用します。
+SOLVER_SYMMETRY_LEVEL = None
+
 # ノード間で共有（中間液を融通）できる液量の最大値を設定します。
 # 例えば 1 に設定すると、共有は「1単位ずつ」に制限されます。
 # Noneの場合は無制限です。
@@ -1,8 +1,31 @@
 # core/dfmm.py
-import math
-import itertools
-from functools import reduce
+from itertools import accumulate
+from functools import lru_cache
 import operator
+from collections import Counter
+
+
+# find_factors_for_sum で表引きを行う ratio_sum の上限値
+# (これより大きい値は、従来どおり divisor を順に試して分解する)
+DIVISOR_TABLE_LIMIT = 10_000
+
+
+@lru_cache(maxsize=None)
+def _largest_divisor_table(max_factor):
+    """
+    n (<= DIVISOR_TABLE_LIMIT) ごとに「max_factor 以下で n を割り切る最大の因数」を
+    格納した表を作成します。該当する因数が無い場合は 0 です。
+    max_factor ごとにキャッシュされるため、MAX_MIXER_SIZE が変われば別の表が作られます。
+
+    (例: max_factor=5 -> table[18] = 3, table[7] = 0)
+    """
+    table = [0] * (DIVISOR_TABLE_LIMIT + 1)
+    # 大きい因数から篩 (ふるい) にかけ、まだ埋まっていない倍数に書き込む
+    for divisor in range(max_factor, 1, -1):
+        for multiple in range(divisor, DIVISOR_TABLE_LIMIT + 1, divisor):
+            if table[multiple] == 0:
+                table[multiple] = divisor
+    return table
 
 
 def find_factors_for_sum(ratio_sum, max_factor):
@@ -25,50 +48,70 @@ def find_factors_for_sum(ratio_sum, max_factor):
         return []
 
     remaining_sum, factors = ratio_sum, []
+    table = _largest_divisor_table(max_factor)
 
     # remaining_sum が 1 になるまで（素因数分解のように）因数で割り続ける
     while remaining_sum > 1:
-        found_divisor = False
-        
-        # 効率化のため、大きな因数(max_factor)から試す
-        for divisor in range(max_factor, 1, -1):
-            if remaining_sum % divisor == 0:
-                # 割り切れた場合
-                factors.append(divisor)      # 因数をリストに追加
-                remaining_sum //= divisor    # remaining_sum を割った値で更新
-                found_divisor = True
-                break # 次の while ループに移る
-                
+        if remaining_sum <= DIVISOR_TABLE_LIMIT:
+            # 表引きで、max_factor 以下の最大の因数を取得
+            divisor = table[remaining_sum]
+        else:
+            # 表の範囲外: 効率化のため、大きな因数(max_factor)から試す
+            divisor = next(
+                (d for d in range(max_factor, 1, -1) if remaining_sum % d == 0), 0
+            )
+
         # どの因数でも割り切れなかった場合 (例: 素数が残ったが max_factor より大きい)
-        if not found_divisor:
+        if divisor == 0:
             print(
                 f"Error: Could not find factors for sum {ratio_sum}. Failed at {remaining_sum}."
             )
             return None # 分解は不可能
 
+        factors.append(divisor)      # 因数をリストに追加
+        remaining_sum //= divisor    # remaining_sum を割った値で更新
+
     # 見つかった因数を降順 (例: [5, 3, 2]) にソートして返す
     return sorted(factors, reverse=True)
 
 
+def _iter_distinct_permutations(counts, prefix, length):
+    """
+    多重集合 (値 -> 残り個数) から、重複の無い順列だけを辞書順に生成するジェネレータ。
+    同じ値を同じ位置に 2 度置かないため、重複した順列はそもそも作られません。
+    """
+    if len(prefix) == length:
+        yield tuple(prefix)
+        return
+    for value in sorted(counts):
+        if counts[value]:
+            counts[value] -= 1
+            prefix.append(value)
+            yield from _iter_distinct_permutations(counts, prefix, length)
+            prefix.pop()
+            counts[value] += 1
+
+
 def generate_unique_permutations(factors):
     """
     因数のリストから、重複を考慮したユニークな順列をすべて生成します。
     'auto_permutations' モードで、最適な混合階層の順序を探索するために使用されます。
 
-    (例: [3, 3, 2] -> [(3, 3, 2), (3, 2, 3), (2, 3, 3)])
+    (例: [3, 3, 2] -> [(2, 3, 3), (3, 2, 3), (3, 3, 2)])
 
     Args:
         factors (list[int]): 因数のリスト。
 
     Returns:
-        list[tuple]: 生成されたユニークな順列のリスト。
+        list[tuple]: 生成されたユニークな順列のリスト (辞書順)。
     """
     if not factors:
         return [()]
     
-    # itertools.permutations ですべての順列を生成
-    # set() を使うことで、同じ順列が複数回現れるのを防ぐ (例: [3, 3, 2] など)
-    return list(set(itertools.permutations(factors)))
+    # itertools.permutations で k! 通りを生成してから set() で重複を除く代わりに、
+    # 各値の個数 (Counter) を使ってユニークな順列だけを直接生成する
+    # (例: [3, 3, 3, 3, 5] -> 120 通りではなく 5 通りのみ生成)
+    return list(_iter_distinct_permutations(Counter(factors), [], len(factors)))
 
 
 def build_dfmm_forest(targets_config):
@@ -82,7 +125,8 @@ def build_dfmm_forest(targets_config):
     Returns:
         list[dict]: 各ツリーのノードと親子関係を格納した辞書のリスト（フォレスト）。
                        各辞書のキーは (level, node_idx) タプル、
-                       値は {'children': list[tuple]} 形式。
+                       値は {'children': list[tuple], 'reagents': list[int]} 形式。
+                       ('reagents' はそのノードに直接投入する各試薬の量)
     """
     forest_structure = [] # 結果を格納するリスト
     
@@ -107,16 +151,17 @@ def build_dfmm_forest(targets_config):
         for level in range(num_levels - 1, -1, -1):
             current_factor = factors[level] # このレベルの混合比 (ミキサーサイズ)
 
-            # 現在のレベルでの混合操作における「余り」と「商」を計算
+            # 現在のレベルでの混合操作における「商」と「余り」を divmod で 1 回の走査で計算
             # (例: level 2, factor=3, values=[2, 11, 5])
-            
-            # 余り: このレベルで直接投入される試薬量に対応
-            # (例: [2 % 3, 11 % 3, 5 % 3] -> [2, 2, 2])
-            level_remainders = [v % current_factor for v in values_to_process]
-            
-            # 商: このレベルの出力となり、上位レベルへの入力となる量に対応
-            # (例: [2 // 3, 11 // 3, 5 // 3] -> [0, 3, 1])
-            level_quotients = [v // current_factor for v in values_to_process]
+            #   商: このレベルの出力となり、上位レベルへの入力となる量に対応
+            #       (例: [2 // 3, 11 // 3, 5 // 3] -> [0, 3, 1])
+            #   余り: このレベルで直接投入される試薬量に対応
+            #       (例: [2 % 3, 11 % 3, 5 % 3] -> [2, 2, 2])
+            level_quotients, level_remainders = [], []
+            for v in values_to_process:
+                quotient, remainder = divmod(v, current_factor)
+                level_quotients.append(quotient)
+                level_remainders.append(remainder)
 
             # 現在のレベルで必要となるノード（ミキサー）の数を計算
             # 入力は、(1) このレベルで直接投入される試薬(余り) と
@@ -125,36 +170,38 @@ def build_dfmm_forest(targets_config):
             total_inputs_at_level = sum(level_remainders) + len(child_node_ids)
 
             # 必要なミキサー数 = ceil(総入力 / 現在レベルの因数)
-            # (例: ceil(6 / 3) = 2)
+            # (float を介さない整数の切り上げ除算。総入力が 0 なら 0)
+            # (例: (6 + 3 - 1) // 3 = 2)
             num_nodes_at_level = (
-                math.ceil(total_inputs_at_level / current_factor)
-                if total_inputs_at_level > 0
-                else 0
-            )
+                total_inputs_at_level + current_factor - 1
+            ) // current_factor
             
             # このレベルに存在するノードIDのリスト (例: [(2, 0), (2, 1)])
             current_level_node_ids = [(level, k) for k in range(num_nodes_at_level)]
 
-            # ノードをツリー構造に追加 (初期状態では子は空リスト)
+            # ノードをツリー構造に追加 (初期状態では子・試薬は空)
             for node_id in current_level_node_ids:
-                tree_structure[node_id] = {"children": []}
+                tree_structure[node_id] = {"children": [], "reagents": [0] * len(ratios)}
 
             # 下のレベルからのノード（子）を、現在のレベルのノード（親）に均等に接続
+            # (i 番目の子は i % num_nodes_at_level 番目の親へ: ラウンドロビン)
             if num_nodes_at_level > 0:
-                parent_node_idx_counter = 0 # 親ノードのインデックス (0, 1, 0, 1, ...)
-                
-                # 各子ノードIDについてループ
-                for child_id in child_node_ids:
-                    # ラウンドロビンで割り当てる親ノードIDを取得 (例: (2, 0))
-                    parent_node_id = current_level_node_ids[parent_node_idx_counter]
-                    
-                    # 親ノードの 'children' リストに子ノードIDを追加
+                for child_pos, child_id in enumerate(child_node_ids):
+                    parent_node_id = current_level_node_ids[child_pos % num_nodes_at_level]
                     tree_structure[parent_node_id]["children"].append(child_id)
-                    
-                    # 次の親ノードのインデックスへ (循環させる)
-                    # (例: (0 + 1) % 2 -> 1)
-                    # (例: (1 + 1) % 2 -> 0)
-                    parent_node_idx_counter = (parent_node_idx_counter + 1) % num_nodes_at_level
+
+            # このレベルで直接投入する試薬 (余り) を、空きのあるノードに前から割り当てる
+            # (各ノードの空き = factor - 子ノード数。子ノードからは 1 単位ずつ受け取る)
+            node_pos = 0
+            for reagent_idx, remainder in enumerate(level_remainders):
+                while remainder > 0 and node_pos < num_nodes_at_level:
+                    node_data = tree_structure[current_level_node_ids[node_pos]]
+                    free = current_factor - len(node_data["children"]) - sum(node_data["reagents"])
+                    amount = min(remainder, free)
+                    node_data["reagents"][reagent_idx] += amount
+                    remainder -= amount
+                    if amount == free:
+                        node_pos += 1
 
             # --- 次の（一つ上の）レベルの計算準備 ---
             
@@ -172,9 +219,12 @@ def build_dfmm_forest(targets_config):
 
 def calculate_p_values_from_structure(forest_structure, targets_config):
     """
-    構築されたツリー構造に基づき、各ノードの「P値」を再帰的に計算します。
+    構築されたツリー構造に基づき、各ノードの「P値」を計算します。
     P値は、そのノードが担当する混合液の相対的な「単位量」を表し、濃度計算の制約に不可欠です。
 
+    子ノードは常に親より 1 つ下のレベルにあるため、レベルの大きい (葉に近い) ノードから
+    順に計算すれば、再帰を使わずに 1 回の走査で全ノードのP値が求まります。
+
     Args:
         forest_structure (list[dict]): build_dfmm_forestで構築されたフォレスト。
         targets_config (list[dict]): 各ターゲットの設定リスト。
@@ -188,50 +238,39 @@ def calculate_p_values_from_structure(forest_structure, targets_config):
     # --- 各ターゲット（ツリー）ごとにループ ---
     for target_idx, tree_structure in enumerate(forest_structure):
         factors = targets_config[target_idx]["factors"] # (例: [3, 2, 3])
-        p_value_cache = {} # 計算結果のメモ化（キャッシュ）用
         p_value_map = {}   # このツリーのP値マップ
 
-        def prod(iterable):
-            """イテラブルなオブジェクトの要素の積を計算するヘルパー関数。"""
-            return reduce(operator.mul, iterable, 1)
-
-        def get_p_for_node(node_id):
-            """メモ化再帰を用いて、特定のノードのP値を計算する。"""
-            
-            # 1. キャッシュにあればそれを返す
-            if node_id in p_value_cache:
-                return p_value_cache[node_id]
+        # 各レベル「以降」の factor の積を事前計算しておく
+        # (例: factors = [3, 2, 3] -> suffix_prod = [18, 6, 3])
+        suffix_prod = list(accumulate(reversed(factors), operator.mul))[::-1]
 
+        # --- レベルの大きい順 (葉 -> root) にP値を計算 ---
+        for node_id in sorted(tree_structure, key=lambda node: -node[0]):
             level, k = node_id # (例: (1, 0))
-            
-            # 2. 子ノードを取得 (存在しない場合は空リスト)
-            children = tree_structure.get(node_id, {}).get("children", [])
+            children = tree_structure[node_id]["children"]
 
-            # 3. P値を計算
             if not children:
                 # 子がいない場合（最下層に近いノード、または試薬のみから成るノード）
                 # P値は、そのレベル「以降」(level=1 なら [2, 3]) のfactorの積
                 # (例: factors = [3, 2, 3], level=1 -> prod([2, 3]) = 6)
                 # (例: factors = [3, 2, 3], level=2 -> prod([3]) = 3)
-                p_value = prod(factors[level:])
+                p_value = suffix_prod[level]
             else:
                 # 子がいる場合
                 # P値は「子のP値の最大値」に「そのレベルのfactor」を掛けたもの
-                
-                # まず、子のP値を再帰的に計算し、その最大値を取得
-                max_child_p = max(get_p_for_node(child_id) for child_id in children)
-                
+                # (子は下位レベルなので、P値は計算済み)
+                # (子は数個しかないため、ジェネレータ式ではなく単純なループで最大値を取る)
                 # (例: level=0, factor=3, max_child_p=6 -> 6 * 3 = 18)
+                max_child_p = 0
+                for child_id in children:
+                    child_p = p_value_map[child_id]
+                    if child_p > max_child_p:
+                        max_child_p = child_p
                 p_value = max_child_p * factors[level]
 
-            # 4. 計算結果をキャッシュして返す
-            p_value_cache[node_id] = p_value
-            return p_value
-
-        # --- ツリー内の全ノードに対してP値を計算 ---
-        for node_id in tree_structure:
-            p_value_map[node_id] = get_p_for_node(node_id)
+            p_value_map[node_id] = p_value
 
-        p_value_maps.append(p_value_map)
+        # キーの並び順は tree_structure と揃えておく
+        p_value_maps.append({node_id: p_value_map[node_id] for node_id in tree_structure})
 
-    return p_value_maps
\ No newline at end of file
+    return p_value_maps
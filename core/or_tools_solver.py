@@ -1,14 +1,12 @@
 # core/or_tools_solver.py (テクニック適用・互換性維持版)
 import time
 import sys
+from collections import defaultdict
 from ortools.sat.python import cp_model  # Or-Tools の CP-SAT ソルバーをインポート
 from utils.config_loader import Config
 from utils import (    
     create_dfmm_node_name,
-    create_intra_key,
-    create_inter_key,
-    create_peer_key,
-    parse_sharing_key,
+    format_sharing_key,
 )
 
 # Pythonの再帰深度の上限を増やす (深いツリー構造での制約設定に対応するため)
@@ -40,14 +38,15 @@ class OrToolsSolutionModel:
         self.forest_vars = forest_vars
         self.peer_vars = peer_vars
         self.num_reagents = problem.num_reagents
+        # 解の全変数値を一度にまとめて取り出しておく (変数インデックス順)
+        self._values = list(solver.ResponseProto().solution)
 
     def _v(self, or_tools_var):
         """
         ヘルパーメソッド: Or-Toolsの変数値を取得します。
-        ソルバーの `Value()` メソッドを呼び出し、Noneの場合は0を返します。
+        (変数ごとにソルバーを呼び出さず、取り出し済みの解の値を参照します)
         """
-        val = self.solver.Value(or_tools_var)
-        return int(val) if val is not None else 0
+        return self._values[or_tools_var.Index()]
 
     def analyze(self):
         """
@@ -118,9 +117,9 @@ class OrToolsSolutionModel:
 
             # ピア(R)ノードの材料(A, B)のノード名を取得
             z3_peer_node = self.problem.peer_nodes[i]
-            m_a, l_a, k_a = z3_peer_node["source_a_id"]
+            m_a, l_a, k_a = z3_peer_node.source_a_id
             name_a = create_dfmm_node_name(m_a, l_a, k_a)
-            m_b, l_b, k_b = z3_peer_node["source_b_id"]
+            m_b, l_b, k_b = z3_peer_node.source_b_id
             name_b = create_dfmm_node_name(m_b, l_b, k_b)
             mixing_str = f"1 x {name_a} + 1 x {name_b}" # 1:1 混合
             level_eff = (l_a + l_b) / 2.0 - 0.5 # グラフ表示用の実効レベル
@@ -165,28 +164,21 @@ class OrToolsSolutionModel:
         # 2. ツリー内(Intra)共有
         for key, w_var in node_vars.get("intra_sharing_vars", {}).items():
             if (val := self._v(w_var)) > 0:
-                key_no_prefix = key.replace("from_", "") # "from_l1k0" -> "l1k0"
-                parsed = parse_sharing_key(key_no_prefix) # -> {"type": "INTRA", "level": 1, "node_idx": 0}
-                node_name = create_dfmm_node_name(
-                    target_idx, parsed["level"], parsed["node_idx"]
-                )
+                l_src, k_src = key # (level, node_idx)
+                node_name = create_dfmm_node_name(target_idx, l_src, k_src)
                 desc.append(f"{val} x {node_name}")
                 
         # 3. ツリー間(Inter)共有
         for key, w_var in node_vars.get("inter_sharing_vars", {}).items():
             if (val := self._v(w_var)) > 0:
-                key_no_prefix = key.replace("from_", "") # "from_t1_l1k0" or "from_R_idx0"
-                parsed = parse_sharing_key(key_no_prefix)
-                
-                if parsed["type"] == "PEER":
+                # key: ("R", peer_idx) または (target_idx, level, node_idx)
+                if key[0] == "R":
                     # 供給元がピア(R)ノードの場合
-                    peer_node_name = self.problem.peer_nodes[parsed["idx"]]["name"]
+                    peer_node_name = self.problem.peer_nodes[key[1]].name
                     desc.append(f"{val} x {peer_node_name}")
-                elif parsed["type"] == "DFMM":
+                else:
                     # 供給元が別ツリーのDFMMノードの場合
-                    node_name = create_dfmm_node_name(
-                        parsed["target_idx"], parsed["level"], parsed["node_idx"]
-                    )
+                    node_name = create_dfmm_node_name(*key)
                     desc.append(f"{val} x {node_name}")
                     
         return " + ".join(desc)
@@ -234,10 +226,25 @@ class OrToolsSolver:
             self.solver.parameters.absolute_gap_limit = float(gap_limit)
             
         # --- テクニック適用 (探索ログの有効化) ---
-        self.solver.parameters.log_search_progress = True
+        self.solver.parameters.log_search_progress = bool(Config.LOG_SEARCH_PROGRESS)
+
+        # --- (3) 線形化レベル (LP緩和の強さ) ---
+        linearization_level = Config.SOLVER_LINEARIZATION_LEVEL
+        if linearization_level is not None:
+            print(f"--- Setting linearization level to {linearization_level} ---")
+            self.solver.parameters.linearization_level = int(linearization_level)
+
+        # --- (4) 対称性検出レベル ---
+        symmetry_level = Config.SOLVER_SYMMETRY_LEVEL
+        if symmetry_level is not None:
+            print(f"--- Setting symmetry level to {symmetry_level} ---")
+            self.solver.parameters.symmetry_level = int(symmetry_level)
             
         self.forest_vars = []             # Or-Tools の DFMM ノード変数を格納
         self.peer_vars = []               # Or-Tools の ピアR ノード変数を格納
+        # 供給元ごとの出力 (共有) 変数の逆引き索引 (変数定義時に登録)
+        self._outgoing_from_dfmm = defaultdict(list)  # (m, l, k) -> [w_var, ...]
+        self._outgoing_from_peer = defaultdict(list)  # peer_idx -> [w_var, ...]
         
         # --- モデル構築の実行 ---
         # 1. Or-Tools の変数を定義
@@ -299,14 +306,15 @@ class OrToolsSolver:
         モデル構築のメインフローを制御するメソッド。
         """
         self._define_or_tools_variables()
+        # (単純な線形制約 (流量・比率の合計・ミキサー容量) を先に追加し、
+        #  掛け算を含む濃度保存則はその後に追加する)
         self._set_initial_constraints()
         self._set_conservation_constraints()
-        self._set_concentration_constraints()
         self._set_ratio_sum_constraints()
-        self._set_leaf_node_constraints()
         self._set_mixer_capacity_constraints()
-        # --- テクニック適用 (_set_range_constraints の呼び出しを削除) ---
-        # self._set_range_constraints() 
+        # ([制約7] 試薬投入量の上限 w_reagent_i <= Factor - 1 は、変数定義時の上限で表現)
+        self._set_concentration_constraints()
+        # ([制約5] リーフノードの制約は、変数定義時に r_i と w_reagent_i を共有することで表現)
         self._set_activity_constraints()
         self._set_peer_mixing_constraints()
         
@@ -315,6 +323,91 @@ class OrToolsSolver:
         
         self.objective_variable = self._set_objective_function()
 
+        # --- テクニック適用 (DFMM の解をヒントとして与える) ---
+        self._add_greedy_hint()
+
+    def _add_greedy_hint(self):
+        """
+        共有を使わない素の DFMM 混合 (build_dfmm_forest が決めた親子関係と試薬の割り当て) を
+        実行可能解のヒント (AddHint) としてモデルに与える。
+        (ヒントは制約ではないため、組み立てられないターゲットはヒントを与えないだけ)
+        """
+        hints = {} # 変数インデックス -> (変数, 値)
+
+        def hint(var, value):
+            hints[var.Index()] = (var, value)
+
+        for target_idx in range(len(self.problem.targets_config)):
+            target_hints = self._build_dfmm_hint(target_idx)
+            if target_hints is None:
+                continue
+            for var, value in target_hints:
+                hint(var, value)
+
+        # ピア(R)ノードは使わない
+        for or_peer_node in self.peer_vars:
+            hint(or_peer_node["is_active_var"], 0)
+            hint(or_peer_node["total_input_var"], 0)
+            hint(or_peer_node["waste_var"], 0)
+            for w_var in or_peer_node["input_vars"].values():
+                hint(w_var, 0)
+
+        for var, value in hints.values():
+            self.model.AddHint(var, value)
+
+    def _build_dfmm_hint(self, target_idx):
+        """
+        1 つのターゲットについて、tree_structures の DFMM 混合に沿った (変数, 値) のリストを返す。
+        (各子ノードは親に 1 単位を渡し、残りは廃棄する)
+        ノードの入力がちょうど Factor にならないなど、組み立てられない場合は None を返す。
+        """
+        factors = self.problem.targets_config[target_idx]["factors"]
+        tree_structure = self.problem.tree_structures[target_idx]
+        p_value_map = self.problem.p_value_maps[target_idx]
+        tree_vars = self.forest_vars[target_idx]
+        reagent_range = range(self.problem.num_reagents)
+
+        result = []
+        ratios = {} # (level, node_idx) -> 比率のリスト
+        # (子ノードの比率が先に決まるよう、レベルの大きい順 (葉 -> root) に処理する)
+        for node_id in sorted(tree_structure, key=lambda node: -node[0]):
+            level, node_idx = node_id
+            node_data = tree_structure[node_id]
+            children = node_data["children"]
+            reagents = node_data["reagents"]
+            f_value = factors[level]
+            p_node = p_value_map[node_id]
+            node_vars = tree_vars[level][node_idx]
+
+            if len(children) + sum(reagents) != f_value:
+                return None # (入力が Factor に一致しない)
+            if any(child not in node_vars["intra_sharing_vars"] for child in children):
+                return None # (子ノードからの共有が許されていない)
+
+            # 濃度保存則: f * r_i = P * w_reagent_i + sum((P / P_child) * r_child_i * 1)
+            ratio = []
+            for t in reagent_range:
+                numerator = p_node * reagents[t] + sum(
+                    (p_node // p_value_map[child]) * ratios[child][t] for child in children
+                )
+                if numerator % f_value:
+                    return None
+                ratio.append(numerator // f_value)
+            ratios[node_id] = ratio
+
+            result.extend(zip(node_vars["ratio_vars"], ratio))
+            result.extend(zip(node_vars["reagent_vars"], reagents))
+            result.append((node_vars["total_input_var"], f_value))
+            result.append((node_vars["is_active_var"], 1))
+            if level != 0:
+                result.append((node_vars["waste_var"], f_value - 1))
+            for key, w_var in node_vars["intra_sharing_vars"].items():
+                result.append((w_var, 1 if key in children else 0))
+            for w_var in node_vars["inter_sharing_vars"].values():
+                result.append((w_var, 0))
+
+        return result
+
     def _define_or_tools_variables(self):
         """
         `core/problem.py` (Z3変数) の構造に基づき、
@@ -323,6 +416,7 @@ class OrToolsSolver:
         
         --- テクニック適用: 変数上限の厳密化 ---
         """
+        reagent_range = range(self.problem.num_reagents)
             
         # 1. DFMMノード変数の定義
         # (self.problem.forest (Z3) の構造をイテレート)
@@ -337,70 +431,109 @@ class OrToolsSolver:
                     p_node = self.problem.p_value_maps[target_idx][(level, node_idx)]
                     f_value = self.problem.targets_config[target_idx]["factors"][level]
                     reagent_max = max(0, f_value - 1)
+                    # リーフノード (P値 == Factor値, 試薬のみで構成) かどうか
+                    is_leaf = p_node == f_value
+                    
+                    # 変数名の共通部分はノードごとに 1 回だけ組み立てる
+                    ratio_prefix = f"ratio_{node_name}_r"
+                    reagent_prefix = f"reagent_vol_{node_name}_r"
+                    share_suffix = f"t{target_idx}_l{level}_k{node_idx}_"
                     
                     # Or-Tools の変数を生成
-                    node_vars = {
-                        "ratio_vars": [ # 比率 (r_i)
+                    if is_leaf:
+                        # [制約5] リーフノードでは r_i = w_reagent_i となるため、
+                        # 等式制約を追加する代わりに同じ変数を共有する
+                        # (上限は両者の小さい方 = reagent_max)
+                        ratio_vars = [
+                            self.model.NewIntVar(0, reagent_max, f"{ratio_prefix}{t}")
+                            for t in reagent_range
+                        ]
+                        reagent_vars = ratio_vars
+                    else:
+                        ratio_vars = [ # 比率 (r_i)
                             self.model.NewIntVar(
-                                0, p_node, f"ratio_{node_name}_r{t}" # 上限: MAX_BOUND -> p_node
+                                0, p_node, f"{ratio_prefix}{t}" # 上限: MAX_BOUND -> p_node
                             )
-                            for t in range(self.problem.num_reagents)
-                        ],
-                        "reagent_vars": [ # 試薬投入量 (w_r_i)
+                            for t in reagent_range
+                        ]
+                        reagent_vars = [ # 試薬投入量 (w_r_i)
                             self.model.NewIntVar(
-                                0, reagent_max, f"reagent_vol_{node_name}_r{t}" # 上限: MAX_BOUND -> reagent_max
+                                0, reagent_max, f"{reagent_prefix}{t}" # 上限: MAX_BOUND -> reagent_max
                             )
-                            for t in range(self.problem.num_reagents)
-                        ],
+                            for t in reagent_range
+                        ]
+                    node_vars = {
+                        "ratio_vars": ratio_vars,
+                        "reagent_vars": reagent_vars,
                         "intra_sharing_vars": {}, # ツリー内共有 (w_intra)
                         "inter_sharing_vars": {}, # ツリー間共有 (w_inter)
-                        "total_input_var": self.model.NewIntVar( # 総入力 (W_total)
-                            0, f_value, f"TotalInput_{node_name}" # 上限: MAX_BOUND -> f_value
+                        # 総入力 (W_total) は 0 (非アクティブ) か f_value (アクティブ) のどちらか
+                        # (root は常に f_value)
+                        "total_input_var": self.model.NewIntVarFromDomain(
+                            cp_model.Domain.FromValues([f_value] if level == 0 else [0, f_value]),
+                            f"TotalInput_{node_name}",
                         ),
                         "is_active_var": self.model.NewBoolVar(f"IsActive_{node_name}"), # ノードが使われているか (Bool)
-                        "waste_var": self.model.NewIntVar( # 廃棄物量 (w_waste)
-                            0, f_value, f"waste_{node_name}" # 上限: MAX_BOUND -> f_value
-                        ),
                     }
+                    if level != 0:
+                        # 廃棄物量 (w_waste) は root 以外のノードのみ
+                        # (root の生成物は最終液であり、廃棄物の式 [10a] を持たないため、
+                        #  変数を作ると制約のない自由変数になってしまう)
+                        node_vars["waste_var"] = self.model.NewIntVar(
+                            0, f_value, f"waste_{node_name}" # 上限: MAX_BOUND -> f_value
+                        )
                     
                     # 共有量の上限を設定
                     # (テクニック適用: f_value と MAX_SHARING_VOLUME の小さい方)
                     max_sharing_vol = min(f_value, Config.MAX_SHARING_VOLUME or f_value)
+                    node_vars["max_sharing_vol"] = max_sharing_vol # (積の変数の上限計算に使用)
                     
                     # ツリー内(Intra)共有変数を定義
-                    for key in z3_node.get("intra_sharing_vars", {}).keys():
-                        share_name = (
-                            f"share_intra_t{target_idx}_l{level}_k{node_idx}_{key}"
-                        )
-                        node_vars["intra_sharing_vars"][key] = self.model.NewIntVar(
+                    for key in z3_node.intra_sharing_vars:
+                        share_name = f"share_intra_{share_suffix}{format_sharing_key(key)}"
+                        w_var = self.model.NewIntVar(
                             0, max_sharing_vol, share_name # 上限: max_sharing_vol (厳密化後)
                         )
+                        node_vars["intra_sharing_vars"][key] = w_var
+                        # (ツリー内の供給元は供給先と同じターゲット)
+                        self._outgoing_from_dfmm[(target_idx, *key)].append(w_var)
                     # ツリー間(Inter)共有変数を定義
-                    for key in z3_node.get("inter_sharing_vars", {}).keys():
-                        share_name = (
-                            f"share_inter_t{target_idx}_l{level}_k{node_idx}_{key}"
-                        )
-                        node_vars["inter_sharing_vars"][key] = self.model.NewIntVar(
+                    for key in z3_node.inter_sharing_vars:
+                        share_name = f"share_inter_{share_suffix}{format_sharing_key(key)}"
+                        w_var = self.model.NewIntVar(
                             0, max_sharing_vol, share_name # 上限: max_sharing_vol (厳密化後)
                         )
+                        node_vars["inter_sharing_vars"][key] = w_var
+                        if key[0] == "R":
+                            self._outgoing_from_peer[key[1]].append(w_var)
+                        else:
+                            self._outgoing_from_dfmm[key].append(w_var)
                     level_nodes.append(node_vars)
                 tree_data[level] = level_nodes
             self.forest_vars.append(tree_data)
+
+        # 全DFMMノードの (target_idx, level, node_idx, node_vars) を 1 度だけ平坦化しておく
+        self._all_node_vars = [
+            (target_idx, level, node_idx, node_vars)
+            for target_idx, tree in enumerate(self.forest_vars)
+            for level, nodes in tree.items()
+            for node_idx, node_vars in enumerate(nodes)
+        ]
             
         # 2. ピア(R)ノード変数の定義
         # (self.problem.peer_nodes (Z3) の構造をイテレート)
         # (ピア(R)ノードの上限値は元から厳密だったため、変更なし)
         for i, z3_peer_node in enumerate(self.problem.peer_nodes):
-            name = z3_peer_node["name"]
-            p_val = z3_peer_node["p_value"]
+            name = z3_peer_node.name
+            p_val = z3_peer_node.p_value
             node_vars = {
                 "name": name,
                 "p_value": p_val,
-                "source_a_id": z3_peer_node["source_a_id"],
-                "source_b_id": z3_peer_node["source_b_id"],
+                "source_a_id": z3_peer_node.source_a_id,
+                "source_b_id": z3_peer_node.source_b_id,
                 "ratio_vars": [ # 比率 (r_i)
                     self.model.NewIntVar(0, p_val, f"ratio_{name}_r{t}")
-                    for t in range(self.problem.num_reagents)
+                    for t in reagent_range
                 ],
                 "input_vars": { # 1:1 混合の入力 (w_a, w_b) (0 or 1)
                     "from_a": self.model.NewIntVar(0, 1, f"share_peer_a_to_{name}"),
@@ -411,6 +544,13 @@ class OrToolsSolver:
                 "waste_var": self.model.NewIntVar(0, 2, f"waste_{name}"), # 廃棄物量
             }
             self.peer_vars.append(node_vars)
+            # ピア(R)ノードの材料 A, B から見ると、これらは出力 (共有) 変数
+            self._outgoing_from_dfmm[z3_peer_node.source_a_id].append(
+                node_vars["input_vars"]["from_a"]
+            )
+            self._outgoing_from_dfmm[z3_peer_node.source_b_id].append(
+                node_vars["input_vars"]["from_b"]
+            )
 
     # --- ヘルパーメソッド (制約設定で使用) ---
 
@@ -424,60 +564,19 @@ class OrToolsSolver:
 
     def _get_outgoing_vars(self, src_target_idx, src_level, src_node_idx):
         """特定のDFMMノードから出ていく全出力変数(共有)のリストを返す"""
-        outgoing = []
-        key_intra = f"from_{create_intra_key(src_level, src_node_idx)}"
-        key_inter = f"from_{create_inter_key(src_target_idx, src_level, src_node_idx)}"
-        
-        # 全DFMMノード (供給先) をチェック
-        for dst_target_idx, tree_dst in enumerate(self.forest_vars):
-            for dst_level, level_dst in tree_dst.items():
-                for dst_node_idx, node_dst in enumerate(level_dst):
-                    # ツリー内共有
-                    if src_target_idx == dst_target_idx and key_intra in node_dst.get(
-                        "intra_sharing_vars", {}
-                    ):
-                        outgoing.append(node_dst["intra_sharing_vars"][key_intra])
-                    # ツリー間共有
-                    elif src_target_idx != dst_target_idx and key_inter in node_dst.get(
-                        "inter_sharing_vars", {}
-                    ):
-                        outgoing.append(node_dst["inter_sharing_vars"][key_inter])
-        
-        # 全ピア(R)ノード (供給先) をチェック
-        for or_peer_node in self.peer_vars:
-            if (
-                src_target_idx,
-                src_level,
-                src_node_idx,
-            ) == or_peer_node["source_a_id"]:
-                outgoing.append(or_peer_node["input_vars"]["from_a"])
-            if (
-                src_target_idx,
-                src_level,
-                src_node_idx,
-            ) == or_peer_node["source_b_id"]:
-                outgoing.append(or_peer_node["input_vars"]["from_b"])
-        return outgoing
+        # (変数定義時に作成した逆引き索引を参照するだけ)
+        return self._outgoing_from_dfmm.get((src_target_idx, src_level, src_node_idx), [])
 
     def _get_outgoing_vars_from_peer(self, peer_node_index):
         """特定のピア(R)ノードから出ていく全出力変数(共有)のリストを返す"""
-        outgoing = []
-        key_inter = f"from_{create_peer_key(peer_node_index)}"
-        
-        # 全DFMMノード (供給先) をチェック
-        for dst_target_idx, tree_dst in enumerate(self.forest_vars):
-            for dst_level, level_dst in tree_dst.items():
-                for dst_node_idx, node_dst in enumerate(level_dst):
-                    if key_inter in node_dst.get("inter_sharing_vars", {}):
-                        outgoing.append(node_dst["inter_sharing_vars"][key_inter])
-        return outgoing
+        return self._outgoing_from_peer.get(peer_node_index, [])
 
     def _iterate_all_nodes(self):
-        """全DFMMノードをイテレートするヘルパージェネレータ"""
-        for target_idx, tree in enumerate(self.forest_vars):
-            for level, nodes in tree.items():
-                for node_idx, node in enumerate(nodes):
-                    yield target_idx, level, node_idx, node
+        """
+        全DFMMノードを (target_idx, level, node_idx, node_vars) でイテレートする。
+        (各制約メソッドが毎回森を走査しないよう、変数定義後に作成したリストを使う)
+        """
+        return iter(self._all_node_vars)
 
     # --- 制約 (Constraints) 設定メソッド ---
 
@@ -497,108 +596,115 @@ class OrToolsSolver:
         for m_src, l_src, k_src, node_vars in self._iterate_all_nodes():
             total_produced = node_vars["total_input_var"]
             # (例: W_total == w_r1 + w_r2 + w_intra_... + w_inter_...)
-            self.model.Add(total_produced == sum(self._get_input_vars(node_vars)))
+            self.model.Add(
+                total_produced == cp_model.LinearExpr.Sum(self._get_input_vars(node_vars))
+            )
 
     def _set_concentration_constraints(self):
         """[制約3] 濃度保存則 (混合方程式)
            f_dst * r_dst_i = sum( (P_dst / P_src) * r_src_i * w_src )
         """
+        # ループ内で繰り返し参照する属性はローカル変数に退避しておく
+        p_value_maps = self.problem.p_value_maps
+        targets_config = self.problem.targets_config
+        forest_vars = self.forest_vars
+        peer_vars = self.peer_vars
+        reagent_range = range(self.problem.num_reagents)
+        # 大量に呼び出すモデルのメソッドもローカル名に束縛しておく
+        add = self.model.Add
+        new_int_var = self.model.NewIntVar
+        add_multiplication_equality = self.model.AddMultiplicationEquality
+        weighted_sum = cp_model.LinearExpr.WeightedSum
+
         for (
             dst_target_idx,
             dst_level,
             dst_node_idx,
             node_vars,
         ) in self._iterate_all_nodes():
-            p_dst = self.problem.p_value_maps[dst_target_idx][(dst_level, dst_node_idx)]
-            f_dst = self.problem.targets_config[dst_target_idx]["factors"][dst_level]
+            p_dst = p_value_maps[dst_target_idx][(dst_level, dst_node_idx)]
+            f_dst = targets_config[dst_target_idx]["factors"][dst_level]
+            # 共有変数 w の上限 (r_src * w の上限は P_src * w_max)
+            w_max = node_vars["max_sharing_vol"]
+
+            # 試薬 (i) に依らない供給元ごとの値を先にまとめておく
+            # (w_var, 供給元の比率変数リスト, P_src)
+            raw_sources = []
+
+            # (B) ツリー内共有からの入力
+            for key, w_var in node_vars["intra_sharing_vars"].items():
+                l_src, k_src = key # (level, node_idx)
+                r_src_vars = forest_vars[dst_target_idx][l_src][k_src]["ratio_vars"]
+                p_src = p_value_maps[dst_target_idx][(l_src, k_src)] # P_src
+                raw_sources.append((w_var, r_src_vars, p_src))
+
+            # (C) ツリー間共有からの入力
+            for key, w_var in node_vars["inter_sharing_vars"].items():
+                if key[0] == "R":
+                    # (C-1) ピア(R)ノードからの入力
+                    or_peer_node = peer_vars[key[1]]
+                    r_src_vars = or_peer_node["ratio_vars"]
+                    p_src = or_peer_node["p_value"] # P_src
+                else:
+                    # (C-2) DFMMノードからの入力
+                    m_src, l_src, k_src = key
+                    r_src_vars = forest_vars[m_src][l_src][k_src]["ratio_vars"]
+                    p_src = p_value_maps[m_src][(l_src, k_src)] # P_src
+                raw_sources.append((w_var, r_src_vars, p_src))
+
+            # (w_var, 比率変数リスト, P_dst / P_src, 積の上限)
+            # (r_src <= P_src, w_var <= w_max なので、積の上限は P_src * w_max)
+            sharing_sources = [
+                (w_var, r_src_vars, p_dst // p_src, min(MAX_PRODUCT_BOUND, p_src * w_max))
+                for w_var, r_src_vars, p_src in raw_sources
+            ]
 
             # 試薬ごと (i) に制約を追加
-            for reagent_idx in range(self.problem.num_reagents):
+            ratio_vars = node_vars["ratio_vars"]
+            reagent_vars = node_vars["reagent_vars"]
+            for reagent_idx in reagent_range:
                 # --- 左辺 (LHS) ---
-                lhs = f_dst * node_vars["ratio_vars"][reagent_idx] # f_dst * r_dst_i
+                lhs = f_dst * ratio_vars[reagent_idx] # f_dst * r_dst_i
                 
                 # --- 右辺 (RHS) ---
-                rhs_terms = []
-                
                 # (A) 試薬からの入力
                 # (P_dst / P_src_reagent) * r_src_reagent * w_src_reagent
                 #   r_src_reagent = 1 (試薬iのみ1, 他は0)
                 #   P_src_reagent = 1 (試薬のP値は1)
                 # -> P_dst * 1 * w_reagent_i
-                rhs_terms.append(p_dst * node_vars["reagent_vars"][reagent_idx])
-
-                # (B) ツリー内共有からの入力
-                for key, w_var in node_vars.get("intra_sharing_vars", {}).items():
-                    key_no_prefix = key.replace("from_", "")
-                    parsed_key = parse_sharing_key(key_no_prefix)
-                    l_src = parsed_key["level"]
-                    k_src = parsed_key["node_idx"]
-                    r_src = self.forest_vars[dst_target_idx][l_src][k_src][
-                        "ratio_vars"
-                    ][reagent_idx] # r_src_i
-                    p_src = self.problem.p_value_maps[dst_target_idx][(l_src, k_src)] # P_src
-                    
+                # (右辺は 変数 と 係数 のリストとして集め、WeightedSum で一度に式にする)
+                rhs_vars = [reagent_vars[reagent_idx]]
+                rhs_coeffs = [p_dst]
+
+                # (B), (C) 共有からの入力
+                for w_var, r_src_vars, scale_factor, product_ub in sharing_sources:
                     # (r_src * w_var) の掛け算を行うための中間変数
-                    prod_name = f"Prod_intra_t{dst_target_idx}l{dst_level}k{dst_node_idx}_r{reagent_idx}_from_{key}"
-                    product_var = self.model.NewIntVar(0, MAX_PRODUCT_BOUND, prod_name)
-                    self.model.AddMultiplicationEquality(product_var, [r_src, w_var])
-                    
-                    scale_factor = p_dst // p_src # (P_dst / P_src)
-                    rhs_terms.append(product_var * scale_factor)
-
-                # (C) ツリー間共有からの入力
-                for key, w_var in node_vars.get("inter_sharing_vars", {}).items():
-                    key_no_prefix = key.replace("from_", "")
-                    parsed_key = parse_sharing_key(key_no_prefix)
-                    if parsed_key["type"] == "PEER":
-                        # (C-1) ピア(R)ノードからの入力
-                        r_node_idx = parsed_key["idx"]
-                        or_peer_node = self.peer_vars[r_node_idx]
-                        r_src = or_peer_node["ratio_vars"][reagent_idx] # r_src_i
-                        p_src = or_peer_node["p_value"] # P_src
+                    # (レポートで参照しない補助変数なので、名前は付けない)
+                    product_var = new_int_var(0, product_ub, "")
+                    r_src = r_src_vars[reagent_idx]
+                    if w_max == 1:
+                        # w_var が 0/1 の場合、積は (w ? r_src : 0) なので
+                        # 掛け算の制約を使わず、条件付きの等式で表す
+                        add(product_var == r_src).OnlyEnforceIf(w_var)
+                        add(product_var == 0).OnlyEnforceIf(w_var.Not())
                     else:
-                        # (C-2) DFMMノードからの入力
-                        m_src = parsed_key["target_idx"]
-                        l_src = parsed_key["level"]
-                        k_src = parsed_key["node_idx"]
-                        r_src = self.forest_vars[m_src][l_src][k_src]["ratio_vars"][
-                            reagent_idx
-                        ] # r_src_i
-                        p_src = self.problem.p_value_maps[m_src][(l_src, k_src)] # P_src
-                    
-                    prod_name = f"Prod_inter_t{dst_target_idx}l{dst_level}k{dst_node_idx}_r{reagent_idx}_from_{key}"
-                    product_var = self.model.NewIntVar(0, MAX_PRODUCT_BOUND, prod_name)
-                    self.model.AddMultiplicationEquality(product_var, [r_src, w_var])
-                    
-                    scale_factor = p_dst // p_src # (P_dst / P_src)
-                    rhs_terms.append(product_var * scale_factor)
+                        add_multiplication_equality(
+                            product_var, [r_src, w_var] # r_src_i * w_src
+                        )
+
+                    rhs_vars.append(product_var)
+                    rhs_coeffs.append(scale_factor) # (P_dst / P_src)
                 
                 # --- 制約を追加 ---
                 # (LHS == sum(RHS))
-                self.model.Add(lhs == sum(rhs_terms))
+                add(lhs == weighted_sum(rhs_vars, rhs_coeffs))
 
     def _set_ratio_sum_constraints(self):
         """[制約4] 各ノードの比率の合計値は、そのノードのP値と一致しなければならない"""
         for target_idx, level, node_idx, node_vars in self._iterate_all_nodes():
             p_node = self.problem.p_value_maps[target_idx][(level, node_idx)]
             # (例: r1 + r2 + r3 == P_node)
-            self.model.Add(sum(node_vars["ratio_vars"]) == p_node)
-
-    def _set_leaf_node_constraints(self):
-        """[制約5] リーフノード(試薬のみで構成されるノード)の制約
-           (P値 == Factor値 となるノード)
-           r_i = w_reagent_i
-        """
-        for target_idx, level, node_idx, node_vars in self._iterate_all_nodes():
-            p_node = self.problem.p_value_maps[target_idx][(level, node_idx)]
-            f_node = self.problem.targets_config[target_idx]["factors"][level]
-            if p_node == f_node:
-                # このノードはリーフノード
-                for reagent_idx in range(self.problem.num_reagents):
-                    self.model.Add(
-                        node_vars["ratio_vars"][reagent_idx]
-                        == node_vars["reagent_vars"][reagent_idx]
-                    )
+            self.model.Add(cp_model.LinearExpr.Sum(node_vars["ratio_vars"]) == p_node)
 
     def _set_mixer_capacity_constraints(self):
         """[制約6] ミキサー容量の制約
@@ -613,22 +719,10 @@ class OrToolsSolver:
                 # rootノードは常にアクティブで、TotalInput == Factor
                 self.model.Add(total_sum == f_value)
             else:
-                # root以外のノードは、アクティブ(is_active=True)の場合のみ制約を適用
-                # (is_active=True) => (TotalInput == f_value)
-                self.model.Add(total_sum == f_value).OnlyEnforceIf(is_active)
-                # (is_active=False) => (TotalInput == 0)
-                self.model.Add(total_sum == 0).OnlyEnforceIf(is_active.Not())
-
-    def _set_range_constraints(self):
-        """[制約7] 試薬投入量の上限
-           w_reagent_i <= Factor - 1
-           (TotalInput が Factor なので、1種類の試薬が Factor 以上になることはない)
-           
-           (テクニック適用により、このメソッドは冗長になったが、
-            元のファイルの構造を維持するため残しておく)
-           (ただし、_define_or_tools_variables で厳密化されたため、呼び出しは不要)
-        """
-        pass # (呼び出されない)
+                # root以外のノードは、アクティブ(is_active=True)の場合のみ TotalInput == f_value
+                # (TotalInput の定義域は {0, f_value} なので、1 本の線形等式で
+                #  is_active=True => f_value, is_active=False => 0 を表せる)
+                self.model.Add(total_sum == f_value * is_active)
 
     def _set_activity_constraints(self):
         """[制約8] ノードのアクティビティ制約
@@ -644,32 +738,21 @@ class OrToolsSolver:
             if src_level == 0:
                 continue # rootノードはスキップ
                 
-            total_prod = node_vars["total_input_var"] # このノードの総生産量
-            total_used = sum( # このノードの総使用量 (出力の合計)
+            total_used = cp_model.LinearExpr.Sum( # このノードの総使用量 (出力の合計)
                 self._get_outgoing_vars(src_target_idx, src_level, src_node_idx)
             )
             is_active = node_vars["is_active_var"] # (TotalInput > 0) を示す変数
             
-            is_used_name = f"IsUsed_t{src_target_idx}_l{src_level}_k{src_node_idx}"
-            is_used = self.model.NewBoolVar(is_used_name) # (TotalUsed > 0) を示す変数
-            
-            self.model.Add(total_used >= 1).OnlyEnforceIf(is_used)
-            self.model.Add(total_used == 0).OnlyEnforceIf(is_used.Not())
-            
-            # (is_active=True) => (is_used=True)
+            # (is_active=True) => (TotalUsed >= 1)
             # (生産されたら、必ず使われなければならない (廃棄は別で計算))
-            self.model.AddImplication(is_active, is_used)
+            # (「使用されたか」を表す中間の BoolVar を介さず、直接 is_active で条件付けする)
+            self.model.Add(total_used >= 1).OnlyEnforceIf(is_active)
             
         # (B) ピア(R)ノード
         for i, or_peer_node in enumerate(self.peer_vars):
-            total_prod = or_peer_node["total_input_var"]
-            total_used = sum(self._get_outgoing_vars_from_peer(i))
+            total_used = cp_model.LinearExpr.Sum(self._get_outgoing_vars_from_peer(i))
             is_active = or_peer_node["is_active_var"]
-            is_used = self.model.NewBoolVar(f"IsUsed_Peer_{i}")
-            
-            self.model.Add(total_used >= 1).OnlyEnforceIf(is_used)
-            self.model.Add(total_used == 0).OnlyEnforceIf(is_used.Not())
-            self.model.AddImplication(is_active, is_used)
+            self.model.Add(total_used >= 1).OnlyEnforceIf(is_active)
 
     def _set_peer_mixing_constraints(self):
         """[制約9] ピア(R)ノードの混合制約
@@ -703,8 +786,9 @@ class OrToolsSolver:
             # [9d] ピア(R)ノードの比率の合計
             p_val = or_peer_node["p_value"]
             r_new_vars = or_peer_node["ratio_vars"]
-            self.model.Add(sum(r_new_vars) == p_val).OnlyEnforceIf(is_active)
-            self.model.Add(sum(r_new_vars) == 0).OnlyEnforceIf(is_active.Not())
+            ratio_sum = cp_model.LinearExpr.Sum(r_new_vars)
+            self.model.Add(ratio_sum == p_val).OnlyEnforceIf(is_active)
+            self.model.Add(ratio_sum == 0).OnlyEnforceIf(is_active.Not())
             
             # [9e] ピア(R)ノードの濃度保存則 (1:1混合)
             #    2 * r_new_i = r_a_i + r_b_i
@@ -717,9 +801,10 @@ class OrToolsSolver:
             m_b, l_b, k_b = or_peer_node["source_b_id"]
             r_b_vars = self.forest_vars[m_b][l_b][k_b]["ratio_vars"]
             
-            for reagent_idx in range(self.problem.num_reagents):
-                lhs = 2 * r_new_vars[reagent_idx]
-                rhs = r_a_vars[reagent_idx] + r_b_vars[reagent_idx]
+            # (試薬 i ごとの 3 つの比率変数を zip でまとめて走査)
+            for r_new, r_a, r_b in zip(r_new_vars, r_a_vars, r_b_vars):
+                lhs = 2 * r_new
+                rhs = r_a + r_b
 
                 # (is_active=1 の場合)
                 # (lhs - rhs <= 0)  (つまり lhs <= rhs)
@@ -754,6 +839,70 @@ class OrToolsSolver:
                         # total_input_k >= total_input_k1 という制約を追加
                         self.model.Add(total_input_k >= total_input_k1)
 
+        # 完全に入れ替え可能なノード (供給元・供給先の候補が同じで、ピアの材料でない)
+        # の組では、さらに比率ベクトルに辞書式順序を付ける
+        # (r_a >=lex r_b を、基数 (P+1) の重み付き和の大小として表す)
+        num_reagents = self.problem.num_reagents
+        for p_node, group in self._find_interchangeable_node_groups():
+            base = p_node + 1
+            if base ** num_reagents < 2 ** 53:
+                weights = [base ** (num_reagents - 1 - t) for t in range(num_reagents)]
+            else:
+                # (重みが大きくなりすぎる場合は、先頭の試薬の比率だけで順序付ける)
+                weights = [1] + [0] * (num_reagents - 1)
+            for vars_a, vars_b in zip(group, group[1:]):
+                self.model.Add(
+                    cp_model.LinearExpr.WeightedSum(vars_a["ratio_vars"], weights)
+                    >= cp_model.LinearExpr.WeightedSum(vars_b["ratio_vars"], weights)
+                )
+
+    def _find_interchangeable_node_groups(self):
+        """
+        同じターゲット・同じレベルにあり、互いに入れ替えても解が変わらないノードの組を探す。
+        (共有を受け取れる供給元のキーと、共有先になり得るノードが完全に一致し、
+         ピア(R)ノードの材料になっていないノード同士)
+
+        Returns:
+            list: (P値, [node_vars, ...]) のリスト (各組はノード番号順, 2 ノード以上)
+        """
+        forest = self.problem.forest
+        p_value_maps = self.problem.p_value_maps
+
+        # 供給元 (m, l, k) -> そこから共有を受け取れるノードの集合
+        consumers = defaultdict(set)
+        for m, l, k, _ in self._iterate_all_nodes():
+            node = forest[m][l][k]
+            for l_src, k_src in node.intra_sharing_vars:
+                consumers[(m, l_src, k_src)].add((m, l, k))
+            for key in node.inter_sharing_vars:
+                if key[0] != "R":
+                    consumers[key].add((m, l, k))
+
+        peer_sources = set()
+        for peer_node in self.problem.peer_nodes:
+            peer_sources.add(peer_node.source_a_id)
+            peer_sources.add(peer_node.source_b_id)
+
+        groups = defaultdict(list)
+        for m, l, k, node_vars in self._iterate_all_nodes():
+            if l == 0 or (m, l, k) in peer_sources:
+                continue
+            node = forest[m][l][k]
+            p_node = p_value_maps[m][(l, k)]
+            signature = (
+                m,
+                l,
+                p_node,
+                frozenset(node.intra_sharing_vars),
+                frozenset(node.inter_sharing_vars),
+                frozenset(consumers[(m, l, k)]),
+            )
+            groups[signature].append(node_vars)
+
+        return [
+            (signature[2], group) for signature, group in groups.items() if len(group) > 1
+        ]
+
     def _set_objective_function(self):
         """[制約10] 目的関数 (最小化の対象) を定義する"""
 
@@ -771,7 +920,7 @@ class OrToolsSolver:
             if src_level != 0:
                 # root ノード以外
                 total_prod = node_vars["total_input_var"] # 総生産量
-                total_used = sum( # 総使用量
+                total_used = cp_model.LinearExpr.Sum( # 総使用量
                     self._get_outgoing_vars(src_target_idx, src_level, src_node_idx)
                 )
                 waste_var = node_vars["waste_var"]
@@ -786,7 +935,7 @@ class OrToolsSolver:
         # 2. ピア(R)ノードの集計
         for i, or_peer_node in enumerate(self.peer_vars):
             total_prod = or_peer_node["total_input_var"]
-            total_used = sum(self._get_outgoing_vars_from_peer(i))
+            total_used = cp_model.LinearExpr.Sum(self._get_outgoing_vars_from_peer(i))
             waste_var = or_peer_node["waste_var"]
             
             # [10b] 廃棄物 = 生産量 - 使用量
@@ -795,9 +944,9 @@ class OrToolsSolver:
             all_activity_vars.append(or_peer_node["is_active_var"])
 
         # 3. 目的変数の設定 
-        total_waste = sum(all_waste_vars)
-        total_operations = sum(all_activity_vars)
-        total_reagents = sum(all_reagent_vars)
+        total_waste = cp_model.LinearExpr.Sum(all_waste_vars)
+        total_operations = cp_model.LinearExpr.Sum(all_activity_vars)
+        total_reagents = cp_model.LinearExpr.Sum(all_reagent_vars)
 
         if self.objective_mode == "waste":
             # [目的1] 総廃棄物量を最小化
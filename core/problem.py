@@ -1,11 +1,51 @@
 import itertools
+from collections import defaultdict
+from dataclasses import dataclass, field
+from functools import lru_cache
 from utils.config_loader import Config
 
-from utils.helpers import (
-    create_intra_key,
-    create_inter_key,
-    create_peer_key,
-)
+
+@dataclass(slots=True)
+class DFMMNode:
+    """
+    DFMM混合ノードの構造情報 (共有を受け取れる供給元のキー)。
+    キーの値はプレースホルダー (None) で、Or-Tools の変数は OrToolsSolver が作成します。
+    """
+    intra_sharing_vars: dict = field(default_factory=dict)  # ツリー内共有のキー
+    inter_sharing_vars: dict = field(default_factory=dict)  # ツリー間共有 / ピア(R)のキー
+
+
+@dataclass(slots=True)
+class PeerNode:
+    """
+    ピア(R)混合ノード (同じP値を持つ 2 ノードを 1:1 で混ぜるノード) の構造情報。
+    Or-Tools の変数 (ratio_vars / input_vars など) は OrToolsSolver 側で保持します。
+    """
+    name: str
+    source_a_id: tuple  # 材料A の (target_idx, level, node_idx)
+    source_b_id: tuple  # 材料B の (target_idx, level, node_idx)
+    p_value: int
+    l_src_eff: int  # 供給元としての実効レベル (材料 2 ノードのレベルの大きい方)
+
+
+@lru_cache(maxsize=None)
+def divisors(q):
+    """
+    正の整数 q の約数を昇順で返します (試し割りは √q まで)。
+    供給元候補を P値 で引くためのキャッシュ付きヘルパー。
+
+    (例: divisors(12) -> (1, 2, 3, 4, 6, 12))
+    """
+    small, large = [], []
+    d = 1
+    while d * d <= q:
+        if q % d == 0:
+            small.append(d)
+            if d != q // d:
+                large.append(q // d)
+        d += 1
+    return tuple(small + large[::-1])
+
 
 class MTWMProblem:
 
@@ -15,7 +55,19 @@ class MTWMProblem:
         self.tree_structures = tree_structures
         self.p_value_maps = p_value_maps
         self.forest = self._define_base_variables()
+        # 全DFMMノードの ID (target_idx, level, node_idx) を 1 度だけ平坦なリストにしておき、
+        # 以降の走査では入れ子の forest をたどらずにこのリストを使う
+        self._all_nodes = [
+            (target_idx, level, node_idx)
+            for target_idx, tree in enumerate(self.forest)
+            for level, nodes in tree.items()
+            for node_idx in range(len(nodes))
+        ]
+        # ピア(R)ノードの材料になり得る root (level 0) 以外のノード
+        self._nonroot_nodes = [node_id for node_id in self._all_nodes if node_id[1] != 0]
+
         self.peer_nodes = self._define_peer_mixing_nodes()
+        self._sources_by_p = self._build_sources_by_p()
         self.potential_sources_map = self._precompute_potential_sources_v2()
         self._define_sharing_variables()
 
@@ -27,22 +79,17 @@ class MTWMProblem:
         forest_data = []
         for target_idx, tree_structure in enumerate(self.tree_structures):
             tree_data = {}
-            levels = sorted({lvl for lvl, _ in tree_structure.keys()})
-
-            for level in levels:
-                nodes_at_level = sorted(
-                    [
-                        node_idx
-                        for lvl_node, node_idx in tree_structure.keys()
-                        if lvl_node == level
-                    ]
-                )
+
+            # (level, node_idx) のキーを 1 回の走査でレベルごとにまとめる
+            level_to_node_idxs = defaultdict(list)
+            for level, node_idx in tree_structure:
+                level_to_node_idxs[level].append(node_idx)
+
+            for level in sorted(level_to_node_idxs):
                 level_nodes = []
-                for node_idx in nodes_at_level:
-                    # ★ プレースホルダーを削除し、空の辞書のみを追加
-                    # この辞書には後に _define_sharing_variables で
-                    # "intra_sharing_vars" と "inter_sharing_vars" が追加されます。
-                    level_nodes.append({})
+                for node_idx in sorted(level_to_node_idxs[level]):
+                    # 共有キーは後に _define_sharing_variables で設定されます。
+                    level_nodes.append(DFMMNode())
 
                 tree_data[level] = level_nodes
             forest_data.append(tree_data)
@@ -52,114 +99,144 @@ class MTWMProblem:
         print("Defining potential peer-mixing nodes (1:1 mix)...")
         peer_nodes = []
 
-        all_dfmm_nodes = []
-        for target_idx, tree in enumerate(self.forest):
-            for level, nodes in tree.items():
-                for node_idx, node in enumerate(nodes):
-                    if level == 0:
-                        continue
-                    # 'node' は空の辞書ですが、存在チェック(combinations)のためタプルに入れます
-                    all_dfmm_nodes.append(((target_idx, level, node_idx), node))
-
-        for (node_a_id, node_a), (node_b_id, node_b) in itertools.combinations(
-            all_dfmm_nodes, 2
-        ):
-            m_a, l_a, k_a = node_a_id
-            m_b, l_b, k_b = node_b_id
-
-            p_val_a = self.p_value_maps[m_a].get((l_a, k_a))
-            p_val_b = self.p_value_maps[m_b].get((l_b, k_b))
-
-            if p_val_a is None or p_val_a != p_val_b:
+        # P値 が等しいノード同士しか組み合わせないため、先に P値 ごとにまとめる
+        # (値は (並び順, ノードID, 葉ノードか) のタプル。葉ノードは P値 == factor)
+        buckets = defaultdict(list)
+        order = 0
+        for node_id in self._nonroot_nodes:
+            target_idx, level, node_idx = node_id
+            p_val = self.p_value_maps[target_idx].get((level, node_idx))
+            if p_val is None:
                 continue
+            is_leaf = p_val == self.targets_config[target_idx]["factors"][level]
+            buckets[p_val].append((order, node_id, is_leaf))
+            order += 1
 
-            f_a = self.targets_config[m_a]["factors"][l_a]
-            f_b = self.targets_config[m_b]["factors"][l_b]
-            is_leaf_a = p_val_a == f_a
-            is_leaf_b = p_val_b == f_b
-            if is_leaf_a and is_leaf_b:
+        pairs = []
+        for p_val, items in buckets.items():
+            if len(items) < 2:
+                # 同じP値のノードが 1 つしかない場合、組み合わせは作れない
                 continue
+            for (order_a, node_a_id, is_leaf_a), (order_b, node_b_id, is_leaf_b) in itertools.combinations(
+                items, 2
+            ):
+                if is_leaf_a and is_leaf_b:
+                    continue
+                pairs.append((order_a, order_b, node_a_id, node_b_id, p_val))
 
+        # 全ノードの組み合わせを走査していた頃と同じ順序に揃え、ピア(R)ノードの
+        # インデックス (R_idx) が実行ごとに変わらないようにする
+        pairs.sort()
+        for _, _, node_a_id, node_b_id, p_val in pairs:
+            m_a, l_a, k_a = node_a_id
+            m_b, l_b, k_b = node_b_id
             name = f"peer_mixer_t{m_a}l{l_a}k{k_a}-t{m_b}l{l_b}k{k_b}"
 
-            peer_node = {
-                "name": name,
-                "source_a_id": node_a_id,
-                "source_b_id": node_b_id,
-                "p_value": p_val_a,
-                # ★ プレースホルダーだった "ratio_vars" と "input_vars" を削除
-            }
-            peer_nodes.append(peer_node)
+            peer_nodes.append(
+                PeerNode(
+                    name=name,
+                    source_a_id=node_a_id,
+                    source_b_id=node_b_id,
+                    p_value=p_val,
+                    l_src_eff=max(l_a, l_b),
+                )
+            )
 
         print(f"  -> Found {len(peer_nodes)} potential peer-mixing combinations.")
         return peer_nodes
 
+    def _build_sources_by_p(self):
+        """
+        全ての供給元候補 (DFMMノード + ピア(R)ノード) を P値 → 実効レベル の 2 段で
+        まとめた索引を作成します。値は (並び順, 供給元ID) のタプルのリストです。
+        (ピア(R)ノードの実効レベルは、材料となる 2 ノードのレベルの大きい方)
+        """
+        sources_by_p = defaultdict(lambda: defaultdict(list))
+        order = 0
+        for node_id in self._all_nodes:
+            target_idx, level, node_idx = node_id
+            p_src = self.p_value_maps[target_idx][(level, node_idx)]
+            sources_by_p[p_src][level].append((order, node_id))
+            order += 1
+        for i, peer_node in enumerate(self.peer_nodes):
+            sources_by_p[peer_node.p_value][peer_node.l_src_eff].append(
+                (order, ("R", i, 0))
+            )
+            order += 1
+        return sources_by_p
+
     def _precompute_potential_sources_v2(self):
+        """
+        各供給先ノードについて、共有を受け取れる供給元の候補リストを事前計算します。
+
+        供給元の P値 は (p_dst // f_dst) の約数でなければならないため、
+        全ペアを調べる代わりに約数ごとに P値 索引 (_sources_by_p) を引きます。
+        索引はさらに実効レベルで分かれているため、レベル条件もノード単位ではなく
+        レベル単位で判定できます。
+        候補の並び順は、全ペアを走査していた頃と同じ (DFMMノード → ピア(R)ノード) です。
+        """
         source_map = {}
-        all_dest_nodes = [
-            (target_idx, level, node_idx)
-            for target_idx, tree in enumerate(self.forest)
-            for level, nodes in tree.items()
-            for node_idx in range(len(nodes))
+        # 供給先ごとに不変な値 (レベル, p_dst // f_dst) を先にまとめておき、
+        # ループ内での p_value_maps / targets_config の辞書参照を避ける
+        # (ノードIDのタプルは _all_nodes のものを再利用し、source_map のキーと
+        #  _sources_by_p 内の供給元IDが同じタプルオブジェクトを共有するようにする)
+        dst_info = [
+            (
+                node_id,
+                node_id[1],
+                self.p_value_maps[node_id[0]][node_id[1:]]
+                // self.targets_config[node_id[0]]["factors"][node_id[1]],
+            )
+            for node_id in self._all_nodes
         ]
-        all_dfmm_sources = list(all_dest_nodes)
-        all_peer_sources = [("R", i, 0) for i in range(len(self.peer_nodes))]
-        all_sources = all_dfmm_sources + all_peer_sources
-
-        for (
-            (dst_target_idx, dst_level, dst_node_idx),
-            (src_target_idx, src_level, src_node_idx),
-        ) in itertools.product(all_dest_nodes, all_sources):
-            p_dst = self.p_value_maps[dst_target_idx][(dst_level, dst_node_idx)]
-            f_dst = self.targets_config[dst_target_idx]["factors"][dst_level]
-
-            if src_target_idx == "R":
-                peer_node = self.peer_nodes[src_level]
-                p_src = peer_node["p_value"]
-                l_src_eff = max(
-                    peer_node["source_a_id"][1], peer_node["source_b_id"][1]
-                )
-                is_valid_level_connection = (l_src_eff > dst_level)
-            else:
-                p_src = self.p_value_maps[src_target_idx][(src_level, src_node_idx)]
-                l_src_eff = src_level
-                if (dst_target_idx, dst_level, dst_node_idx) == (
-                    src_target_idx,
-                    src_level,
-                    src_node_idx,
-                ):
-                    continue
+        sources_by_p = self._sources_by_p
+        allow_final_product = Config.ENABLE_FINAL_PRODUCT_SHARING
+        # MAX_LEVEL_DIFF が無い場合は、森の最大レベルを差の上限として使う
+        # (どの供給元もこの上限を超えないため、ループ内で None 判定をせずに済む)
+        max_level_diff = Config.MAX_LEVEL_DIFF
+        if max_level_diff is None:
+            max_level_diff = max((level for _, level, _ in self._all_nodes), default=0)
 
-                # 1. 供給元が中間ノード (level > 0) の場合
-                is_intermediate_node_connection = (l_src_eff > dst_level)
-                
-                # 2. 供給元が最終ノード (level == 0) の場合
-                #    Config フラグが True の場合のみ許可
-                is_final_node_connection = (
-                    (l_src_eff == 0) and Config.ENABLE_FINAL_PRODUCT_SHARING
-                )
-                
-                # どちらかがTrueであれば有効
-                is_valid_level_connection = (
-                    is_intermediate_node_connection or is_final_node_connection
-                )
-            if not is_valid_level_connection:
-                continue
-            if Config.MAX_LEVEL_DIFF is not None and l_src_eff > dst_level + Config.MAX_LEVEL_DIFF:
-                continue
-            if (p_dst // f_dst) % p_src != 0:
-                continue
+        for dst_id, dst_level, q_dst in dst_info:
+            # MAX_LEVEL_DIFF による供給元の実効レベルの上限
+            max_src_level = dst_level + max_level_diff
+            candidates = []
+            for p_src in divisors(q_dst):
+                sources_by_level = sources_by_p.get(p_src)
+                if not sources_by_level:
+                    continue
+                for l_src_eff, entries in sources_by_level.items():
+                    if l_src_eff > max_src_level:
+                        continue
+                    if l_src_eff > dst_level:
+                        # 1. 供給元が中間ノード (供給先より下位のレベル) の場合
+                        #    (ピア(R)ノードもこの条件でのみ供給可能)
+                        candidates.extend(entries)
+                    elif l_src_eff == 0 and allow_final_product:
+                        # 2. 供給元が最終ノード (level == 0) の場合
+                        #    Config フラグが True の場合のみ許可 (自分自身は除く)
+                        #    (ピア(R)ノードの実効レベルは常に 1 以上のため、
+                        #     ここに含まれるのは DFMM の最終ノードのみ)
+                        candidates.extend(
+                            (order, src_id)
+                            for order, src_id in entries
+                            if src_id != dst_id
+                        )
 
-            key = (dst_target_idx, dst_level, dst_node_idx)
-            if key not in source_map:
-                source_map[key] = []
-            source_map[key].append((src_target_idx, src_level, src_node_idx))
+            if candidates:
+                candidates.sort()
+                source_map[dst_id] = [src_id for _, src_id in candidates]
         return source_map
 
     def _create_sharing_vars_for_node(self, dst_target_idx, dst_level, dst_node_idx):
         """
         共有液量を表す変数の「キー」の辞書を作成します。
         値は OrToolsSolver が設定するため、ここではプレースホルダー (None) すら不要です。
+
+        キーは文字列ではなく整数のタプルです (文字列の生成・ハッシュ計算を避けるため)。
+            ツリー内(Intra): (src_level, src_node_idx)
+            ツリー間(Inter): (src_target_idx, src_level, src_node_idx)
+            ピア(R):         ("R", peer_idx)
         """
         potential_sources = self.potential_sources_map.get(
             (dst_target_idx, dst_level, dst_node_idx), []
@@ -169,29 +246,20 @@ class MTWMProblem:
         for src_target_idx, src_level, src_node_idx in potential_sources:
             if src_target_idx == dst_target_idx:
                 # (ツリー内)
-                key_str = create_intra_key(src_level, src_node_idx)
-                key = f"from_{key_str}"
-                intra_vars[key] = None # ★ OrToolsSolver がキーのみ参照するため None を設定
+                intra_vars[(src_level, src_node_idx)] = None # ★ OrToolsSolver がキーのみ参照するため None を設定
+            elif src_target_idx == "R":
+                # (ピア R)
+                inter_vars[("R", src_level)] = None # ★
             else:
-                if src_target_idx == "R":
-                    # (ピア R)
-                    key_str = create_peer_key(src_level)
-                    key = f"from_{key_str}"
-                    inter_vars[key] = None # ★
-                else:
-                    # (ツリー間)
-                    key_str = create_inter_key(src_target_idx, src_level, src_node_idx)
-                    key = f"from_{key_str}"
-                    inter_vars[key] = None # ★
+                # (ツリー間)
+                inter_vars[(src_target_idx, src_level, src_node_idx)] = None # ★
         return intra_vars, inter_vars
 
     def _define_sharing_variables(self):
-        for dst_target_idx, tree_dst in enumerate(self.forest):
-            for dst_level, nodes_dst in tree_dst.items():
-                for dst_node_idx, node in enumerate(nodes_dst):
-                    intra, inter = self._create_sharing_vars_for_node(
-                        dst_target_idx, dst_level, dst_node_idx
-                    )
-                    # node (空の辞書) にキーを追加
-                    node["intra_sharing_vars"] = intra
-                    node["inter_sharing_vars"] = inter
+        for dst_target_idx, dst_level, dst_node_idx in self._all_nodes:
+            intra, inter = self._create_sharing_vars_for_node(
+                dst_target_idx, dst_level, dst_node_idx
+            )
+            node = self.forest[dst_target_idx][dst_level][dst_node_idx]
+            node.intra_sharing_vars = intra
+            node.inter_sharing_vars = inter
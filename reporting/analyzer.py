@@ -121,7 +121,7 @@ class PreRunAnalyzer:
             for i, peer_node in enumerate(self.problem.peer_nodes):
                 # (例: Node peer_mixer_...: P = 6)
                 content.append(
-                    f"  Node {peer_node['name']}: P = {peer_node['p_value']}"
+                    f"  Node {peer_node.name}: P = {peer_node.p_value}"
                 )
 
         return content
@@ -165,8 +165,8 @@ class PreRunAnalyzer:
                         # 供給元がピア(R)ノードの場合
                         try:
                             peer_node = self.problem.peer_nodes[src_level]
-                            p_src = peer_node["p_value"]
-                            src_name = peer_node["name"]
+                            p_src = peer_node.p_value
+                            src_name = peer_node.name
                         except (IndexError, KeyError):
                             p_src = "N/A"
                             src_name = f"Invalid_R_Node_idx{src_level}"
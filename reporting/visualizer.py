@@ -3,7 +3,7 @@ import os
 import networkx as nx  # グラフ構造の作成・操作
 import matplotlib.pyplot as plt # グラフの描画
 import matplotlib.colors as mcolors # 色の正規化
-from utils import create_dfmm_node_name, parse_sharing_key
+from utils import create_dfmm_node_name
 
 
 class SolutionVisualizer:
@@ -122,8 +122,8 @@ class SolutionVisualizer:
 
             # ピア(R)ノードの材料(A, B)の情報を problem から取得
             z3_peer_node = self.problem.peer_nodes[i]
-            src_a_id = z3_peer_node["source_a_id"]
-            src_b_id = z3_peer_node["source_b_id"]
+            src_a_id = z3_peer_node.source_a_id
+            src_b_id = z3_peer_node.source_b_id
 
             # グラフ表示用の実効レベルとターゲットID
             peer_level = (src_a_id[1] + src_b_id[1]) / 2.0 - 0.5
@@ -209,34 +209,25 @@ class SolutionVisualizer:
         }
         for key, w_var in all_sharing.items():
             if (val := self.model._v(w_var)) > 0:
-                # 共有キー (例: "from_t1_l1_k0") から
+                # 共有キー (例: (1, 1, 0)) から
                 # 供給元(src)のノード名 (例: "mixer_t1_l1_k0") を特定
                 src_name = self._parse_source_node_name(key, dest_target_idx)
                 G.add_edge(src_name, dest_name, volume=val)
                 edge_volumes[(src_name, dest_name)] = val
 
     def _parse_source_node_name(self, key, dest_target_idx):
-        """ヘルパー: 共有キー文字列 ("from_...") から供給元ノード名を逆引きする"""
-        key_no_prefix = key.replace("from_", "")
+        """ヘルパー: 共有キー (タプル) から供給元ノード名を逆引きする"""
         try:
-            parsed_key = parse_sharing_key(key_no_prefix) # utils/helpers の関数
-            if parsed_key["type"] == "PEER":
-                idx = parsed_key["idx"]
-                return self.problem.peer_nodes[idx]["name"]
-            elif parsed_key["type"] == "DFMM":
-                return create_dfmm_node_name(
-                    parsed_key["target_idx"],
-                    parsed_key["level"],
-                    parsed_key["node_idx"],
-                )
-            elif parsed_key["type"] == "INTRA":
+            if key[0] == "R":
+                # ピア(R): ("R", peer_idx)
+                return self.problem.peer_nodes[key[1]].name
+            elif len(key) == 3:
+                # ツリー間(Inter): (target_idx, level, node_idx)
+                return create_dfmm_node_name(*key)
+            elif len(key) == 2:
                 # ツリー内(Intra)共有の場合、ターゲットIDは供給先(dest)と同じ
-                return create_dfmm_node_name(
-                    dest_target_idx,
-                    parsed_key["level"],
-                    parsed_key["node_idx"],
-                )
-        except (IndexError, KeyError, ValueError):
+                return create_dfmm_node_name(dest_target_idx, key[0], key[1])
+        except (IndexError, KeyError, TypeError):
             return f"Invalid_Node_Key_{key}"
 
     def _calculate_node_positions(self, G):
@@ -0,0 +1,76 @@
+# tests/test_or_tools_solver.py
+import contextlib
+import io
+import unittest
+
+from ortools.sat.python import cp_model
+
+from core import (
+    MTWMProblem,
+    OrToolsSolver,
+    build_dfmm_forest,
+    calculate_p_values_from_structure,
+)
+from utils.config_loader import Config
+
+# (小さめのターゲット構成: 2 ターゲット / 3 ターゲット / 5 試薬)
+TARGET_CONFIGS = [
+    [
+        {"name": "T1", "ratios": [2, 11, 5], "factors": [3, 3, 2]},
+        {"name": "T2", "ratios": [60, 25, 5], "factors": [5, 3, 3, 2]},
+    ],
+    [
+        {"name": "T1", "ratios": [1, 8, 9], "factors": [3, 3, 2]},
+        {"name": "T2", "ratios": [2, 1, 15], "factors": [3, 3, 2]},
+        {"name": "T3", "ratios": [4, 5, 9], "factors": [3, 3, 2]},
+    ],
+    [
+        {"name": "T1", "ratios": [2, 3, 7], "factors": [3, 2, 2]},
+        {"name": "T2", "ratios": [1, 5, 6], "factors": [3, 2, 2]},
+    ],
+    [{"name": "T1", "ratios": [1, 1, 1, 1, 4], "factors": [2, 2, 2]}],
+]
+
+
+def build_solver(targets_config):
+    """ターゲット構成から OrToolsSolver を構築する (構築中の出力は捨てる)"""
+    tree_structures = build_dfmm_forest(targets_config)
+    p_value_maps = calculate_p_values_from_structure(tree_structures, targets_config)
+    with contextlib.redirect_stdout(io.StringIO()):
+        problem = MTWMProblem(targets_config, tree_structures, p_value_maps)
+        return OrToolsSolver(problem, objective_mode="waste")
+
+
+class GreedyHintTest(unittest.TestCase):
+    """DFMM 混合のヒント (_add_greedy_hint) のテスト"""
+
+    def setUp(self):
+        # (ログの抑制と、ヒント検証用のソルバー設定)
+        self._saved = (Config.LOG_SEARCH_PROGRESS, Config.MAX_CPU_WORKERS)
+        Config.LOG_SEARCH_PROGRESS = False
+        Config.MAX_CPU_WORKERS = 1
+
+    def tearDown(self):
+        Config.LOG_SEARCH_PROGRESS, Config.MAX_CPU_WORKERS = self._saved
+
+    def test_hint_covers_every_dfmm_node(self):
+        for targets_config in TARGET_CONFIGS:
+            solver = build_solver(targets_config)
+            hinted = set(solver.model.Proto().solution_hint.vars)
+            for _, _, _, node_vars in solver._iterate_all_nodes():
+                self.assertIn(node_vars["total_input_var"].Index(), hinted)
+                for var in node_vars["ratio_vars"] + node_vars["reagent_vars"]:
+                    self.assertIn(var.Index(), hinted)
+
+    def test_hint_is_feasible(self):
+        for targets_config in TARGET_CONFIGS:
+            solver = build_solver(targets_config)
+            # ヒントの値に変数を固定しても解が存在すること
+            solver.solver.parameters.fix_variables_to_their_hinted_value = True
+            solver.solver.parameters.max_time_in_seconds = 30.0
+            status = solver.solver.Solve(solver.model)
+            self.assertIn(status, (cp_model.OPTIMAL, cp_model.FEASIBLE))
+
+
+if __name__ == "__main__":
+    unittest.main()
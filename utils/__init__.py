@@ -5,7 +5,7 @@ from .helpers import (
     create_intra_key,
     create_inter_key,
     create_peer_key,
-    parse_sharing_key,
+    format_sharing_key,
     generate_config_hash,
     generate_random_ratios
 )
@@ -16,7 +16,7 @@ __all__ = [
     "create_intra_key",
     "create_inter_key",
     "create_peer_key",
-    "parse_sharing_key",
+    "format_sharing_key",
     "generate_config_hash",
     "generate_random_ratios",
 ]
\ No newline at end of file
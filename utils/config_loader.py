@@ -23,6 +23,9 @@ class Config:
     MAX_CPU_WORKERS = config.MAX_CPU_WORKERS
     MAX_TIME_PER_RUN_SECONDS = config.MAX_TIME_PER_RUN_SECONDS
     ABSOLUTE_GAP_LIMIT = config.ABSOLUTE_GAP_LIMIT
+    LOG_SEARCH_PROGRESS = config.LOG_SEARCH_PROGRESS
+    SOLVER_LINEARIZATION_LEVEL = config.SOLVER_LINEARIZATION_LEVEL
+    SOLVER_SYMMETRY_LEVEL = config.SOLVER_SYMMETRY_LEVEL
     MAX_SHARING_VOLUME = config.MAX_SHARING_VOLUME
     MAX_LEVEL_DIFF = config.MAX_LEVEL_DIFF
     MAX_MIXER_SIZE = config.MAX_MIXER_SIZE
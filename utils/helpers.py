@@ -1,11 +1,10 @@
 import json
 import hashlib
 import random
-import re
 import math
-from functools import reduce
+from functools import lru_cache, reduce
 
-# --- キー生成・解析関数 (docstring追加) ---
+# --- キー生成関数 (docstring追加) ---
 
 # グラフノードや共有キーの識別子として使う接頭辞（プレフィックス）を定義
 KEY_INTRA_PREFIX = "l"  # ツリー内(Intra-tree)共有キーの接頭辞
@@ -13,8 +12,10 @@ KEY_INTER_PREFIX = "t"  # ツリー間(Inter-tree)共有キーの接頭辞
 KEY_PEER_PREFIX = "R_idx"  # ピア(R)ノード共有キーの接頭辞
 
 
+@lru_cache(maxsize=None)
 def create_dfmm_node_name(target_idx, level, node_idx):
     """DFMMノードのグローバル名（全体で一意な名前）を生成します。
+    (ソルバー・解析・可視化で同じノード名を何度も使うため、結果はキャッシュします)
 
     Args:
         target_idx (int): ターゲットのインデックス (例: 0)。
@@ -72,63 +73,25 @@ def create_peer_key(peer_idx):
     return f"{KEY_PEER_PREFIX}{peer_idx}"
 
 
-def parse_sharing_key(key_str_no_prefix):
+def format_sharing_key(key):
     """
-    共有キー文字列 ('from_' を除いた本体部分) を解析し、
-    供給元の種類とインデックス情報を辞書で返します。
+    タプル形式の共有キーを、'from_' プレフィックス付きの文字列形式に変換します。
+    (共有キー自体はタプルで扱い、文字列は変数名や表示用にのみ生成する)
 
     Args:
-        key_str_no_prefix (str): 'from_' を除いたキー文字列 (例: 'R_idx0', 't0_l1k0', 'l1k0')。
+        key (tuple): 共有キー。
+            ツリー内(Intra): (level, node_idx)
+            ツリー間(Inter): (target_idx, level, node_idx)
+            ピア(R):         ("R", peer_idx)
 
     Returns:
-        dict: 解析結果。キーは 'type' ('PEER', 'DFMM', 'INTRA') と、
-              タイプに応じたインデックス ('idx', 'target_idx', 'level', 'node_idx')。
-
-    Raises:
-        ValueError: 未知のキー形式の場合。
+        str: 文字列形式のキー (例: 'from_l1k0', 'from_t0_l1k0', 'from_R_idx0')。
     """
-    # 1. ピア(R)ノードのキーかチェック (例: 'R_idx0')
-    if key_str_no_prefix.startswith(KEY_PEER_PREFIX):
-        # 'R_idx' の部分を取り除き、残った数値(インデックス)を整数に変換
-        return {
-            "type": "PEER",
-            "idx": int(key_str_no_prefix.replace(KEY_PEER_PREFIX, "")),
-        }
-
-    # 2. ツリー間(Inter)共有キーかチェック (例: 't0_l1k0')
-    elif key_str_no_prefix.startswith(KEY_INTER_PREFIX):
-        # 正規表現(re.match)でパターンに一致するか確認
-        # r"t(\d+)_l(\d+)k(\d+)" は以下のパターンを探す
-        #   t: 't'という文字
-        #   (\d+): 1桁以上の数字（これが group(1) = target_idx になる）
-        #   _l: '_l'という文字
-        #   (\d+): 1桁以上の数字（これが group(2) = level になる）
-        #   k: 'k'という文字
-        #   (\d+): 1桁以上の数字（これが group(3) = node_idx になる）
-        match = re.match(r"t(\d+)_l(\d+)k(\d+)", key_str_no_prefix)
-        if match:
-            # マッチした場合、キャプチャしたグループを辞書に格納
-            return {
-                "type": "DFMM",  # ツリー間共有の供給元はDFMMノード
-                "target_idx": int(match.group(1)),
-                "level": int(match.group(2)),
-                "node_idx": int(match.group(3)),
-            }
-
-    # 3. ツリー内(Intra)共有キーかチェック (例: 'l1k0')
-    elif key_str_no_prefix.startswith(KEY_INTRA_PREFIX):
-        # 正規表現でパターンに一致するか確認 (t(\d+)_ がないパターン)
-        match = re.match(r"l(\d+)k(\d+)", key_str_no_prefix)
-        if match:
-            # マッチした場合、キャプチャしたグループを辞書に格納
-            return {
-                "type": "INTRA",
-                "level": int(match.group(1)),
-                "node_idx": int(match.group(2)),
-            }
-
-    # 4. どのパターンにも一致しなかった場合
-    raise ValueError(f"Unknown sharing key format: {key_str_no_prefix}")
+    if key[0] == "R":
+        return f"from_{create_peer_key(key[1])}"
+    if len(key) == 2:
+        return f"from_{create_intra_key(*key)}"
+    return f"from_{create_inter_key(*key)}"
 
 def _calculate_gcd_for_list(numbers):
     """リスト内のすべての数値の最大公約数（GCD）を計算します。"""